@@ -12,28 +12,39 @@ Purpose: Interactive map + AI Q&A for China's National 5A‑rated tourist attrac
     • Responsive layout: desktop & mobile
 
 Run      :  streamlit run 5a_map_streamlit.py
-Requires :  pip install streamlit pandas folium requests python-dotenv
+Requires :  pip install streamlit pandas pyarrow folium requests python-dotenv diskcache
 -------------------------------------------------
 """
 
 from pathlib import Path
 
 import streamlit as st
+from streamlit.logger import get_logger
 import pandas as pd
 import folium
-from folium.plugins import MarkerCluster, BeautifyIcon
-from streamlit_folium import st_folium
+from folium.plugins import FastMarkerCluster
 
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
-import threading, queue, time
+import functools
+import hashlib
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import diskcache
 from dotenv import load_dotenv, find_dotenv
 
 load_dotenv(find_dotenv())  # load variables from .env if present
+logger = get_logger(__name__)   # 使用 Streamlit 的 handler/级别；裸 logging 会丢弃 INFO
 # ────────────── 路径配置 ──────────────
 BASE_DIR = Path(__file__).resolve().parent
 DATA_CSV = BASE_DIR / "5A_scenic_geo_places.csv"
+ANSWER_CACHE_DIR = BASE_DIR / ".deepseek_cache"
 
 # DeepSeek API Key (set DEEPSEEK_API_KEY in your shell or .env)
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY", "")
@@ -51,98 +62,380 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
+# ────────────── 缓存观测计数 ──────────────
+@st.cache_resource
+def get_cache_counters() -> tuple[Counter, threading.Lock]:
+    """Process-wide call/miss counters for the cached functions below (shown with ?debug=1) + their lock."""
+    return Counter(), threading.Lock()
+
+CACHE_COUNTERS, CACHE_COUNTERS_LOCK = get_cache_counters()
+
+def bump_counter(key: str) -> None:
+    """Increment a counter; every session's script thread writes here, so hold the lock."""
+    with CACHE_COUNTERS_LOCK:
+        CACHE_COUNTERS[key] += 1
+
+def count_calls(name: str):
+    """Count calls of a cached function; its body counts misses, so hits = calls - misses."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bump_counter(f"{name}.calls")
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
 # ────────────── 读取数据 ──────────────
-@st.cache_data
+@st.cache_resource   # 只读共享：每次 rerun 不再反序列化整表
 def load_df(path: Path, mtime: float) -> pd.DataFrame:   # mtime 参与 key
-    df_ = pd.read_csv(path)
-    return df_.dropna(subset=["longitude", "latitude"])
+    # pyarrow 解析 + category：isin 掩码走分类编码
+    # 经纬度保持 float64：float32 转回 JSON 会变成 17 位小数并偏移坐标
+    df_ = pd.read_csv(
+        path,
+        engine="pyarrow",
+        dtype={
+            "province": "category",
+            "city": "category",
+            "scenic": "string",
+        },
+    )
+    # 无省份的行任何筛选下都不会显示，读入时一并丢弃
+    return df_.dropna(subset=["longitude", "latitude", "province"])
 
 df = load_df(DATA_CSV, DATA_CSV.stat().st_mtime)         # include mtime so cache invalidates on file update
 
+@st.cache_data
+def prov_city_index(_df: pd.DataFrame, mtime: float) -> dict[str, list[str]]:   # _df 不参与哈希，mtime 作 key
+    """province → sorted unique cities, built once instead of masking df on every rerun."""
+    return {
+        p: sorted(g["city"].dropna().unique().tolist())
+        for p, g in _df.groupby("province", sort=False, observed=True)
+    }
+
+PROV2CITIES = prov_city_index(df, DATA_CSV.stat().st_mtime)
+ALL_PROVINCES = set(PROV2CITIES)
+ALL_CITIES = {c for cs in PROV2CITIES.values() for c in cs}
+
 # ────────────── 左栏筛选 ──────────────
 with st.sidebar:
     st.header("筛选")
     provinces = sorted(df["province"].dropna().unique())
     sel_provinces = st.multiselect("省份", provinces, default=provinces)
 
-    cities = sorted(
-        df.loc[df["province"].isin(sel_provinces), "city"].dropna().unique()
-    )
+    cities = sorted({c for p in sel_provinces for c in PROV2CITIES.get(p, ())})
     sel_cities = st.multiselect("城市", cities, default=cities)
 
 MUNICIPALITIES = {"北京市", "上海市", "天津市", "重庆市"}
 
 # ────────────── 构建过滤掩码 ──────────────
-mask_prov = df["province"].isin(sel_provinces)
+def _filter_view(prov_key: tuple, city_key: tuple) -> pd.DataFrame:
+    all_prov = set(prov_key) >= ALL_PROVINCES
+    # 默认全选状态：免去对城市列表做 isin（无城市的非直辖市行仍需排除）
+    if all_prov and set(city_key) >= ALL_CITIES:
+        return df[df["city"].notna() | df["province"].isin(MUNICIPALITIES)].reset_index(drop=True)
+
+    # 直辖市：若省份被选中，则忽略 city 字段，直接全部包含
+    muni_selected = set(prov_key) & MUNICIPALITIES
+    mask_city = (
+        df["city"].isin(city_key) |             # 普通城市正常匹配
+        df["province"].isin(muni_selected)      # 选中的直辖市全量匹配
+    )
+    # 全部省份被选中时省份掩码恒为 True，跳过
+    if all_prov:
+        return df[mask_city].reset_index(drop=True)
+    return df[df["province"].isin(prov_key) & mask_city].reset_index(drop=True)
 
-# 直辖市：若省份被选中，则忽略 city 字段，直接全部包含
-muni_selected = set(sel_provinces) & MUNICIPALITIES
-mask_city = (
-    df["city"].isin(sel_cities) |           # 普通城市正常匹配
-    df["province"].isin(muni_selected)      # 选中的直辖市全量匹配
-)
+CHINA_CENTER = (35.0, 103.8)
+# 经纬度跨度（度）→ 初始缩放级别；超出最后一档用 4（全国视野）
+ZOOM_BY_SPAN = ((0.5, 10), (1.5, 9), (3, 8), (6, 7), (12, 6), (24, 5))
 
-df_view = df[mask_prov & mask_city]
+def view_bounds(df_subset: pd.DataFrame) -> tuple[float, float, int]:
+    """Map center (bounding-box midpoint) and a zoom level derived from the larger lat/lon span."""
+    if df_subset.empty:
+        return (*CHINA_CENTER, 4)
+    lats = df_subset["latitude"].to_numpy()
+    lons = df_subset["longitude"].to_numpy()
+    lat_min, lat_max = float(lats.min()), float(lats.max())
+    lon_min, lon_max = float(lons.min()), float(lons.max())
+    span = max(lat_max - lat_min, lon_max - lon_min)
+    zoom = next((z for limit, z in ZOOM_BY_SPAN if span <= limit), 4)
+    return (lat_min + lat_max) / 2, (lon_min + lon_max) / 2, zoom
+
+@st.cache_resource(show_spinner=False, max_entries=64)   # 视图只读：命中时返回同一对象，不做反序列化拷贝
+def _cached_view(prov_key: tuple, city_key: tuple,
+                 mtime: float) -> tuple[pd.DataFrame, tuple[float, float, int]]:   # mtime 参与 key
+    """Filtered view + (lat, lon, zoom) memoized per selection fingerprint; cache hits skip masks and reductions."""
+    bump_counter("compute_view.misses")
+    df_sub = _filter_view(prov_key, city_key)
+    return df_sub, view_bounds(df_sub)
+
+# 脚本主流程走计数版本；build_map_cached 内部直接用 _cached_view，避免重复计入命中
+compute_view = count_calls("compute_view")(_cached_view)
+
+# 选择指纹：排序后的小元组，作为缓存 key（避免对 DataFrame 做哈希）
+prov_key = tuple(sorted(sel_provinces))
+city_key = tuple(sorted(sel_cities))
+
+df_view, _ = compute_view(prov_key, city_key, DATA_CSV.stat().st_mtime)
 
 st.info(f"共 **{len(df_view)}** 个景点", icon="🚗")
 
 # ────────────── 生成动态 Folium ──────────────
-def build_map(df_subset: pd.DataFrame) -> folium.Map:
-    # 空集则定位中国中心
+# popup 模板：依次填入 scenic / province / city
+POPUP_TMPL = (
+    '<div style="padding:6px 10px;border-radius:8px;'
+    'background:#ffffff;box-shadow:0 1px 4px rgba(0,0,0,.15);'
+    'font-weight:500;font-size:0.75em;">%s'
+    '<br/><small style="font-size:0.4em;">%s·%s</small></div>'
+)
+
+# FastMarkerCluster 回调：row = [lat, lon, scenic, province, city]
+# 模板静态片段与样式对象只创建一次，逐点只做拼接
+MARKER_CALLBACK_JS = """
+(function () {
+    var parts = %s;
+    var style = {
+        radius: 6, color: "#4a4a4a", weight: 1,
+        fill: true, fillColor: "#f5f5f5", fillOpacity: 1
+    };
+    return function (row) {
+        var popup = parts[0] + row[2] + parts[1] + row[3] + parts[2] + row[4] + parts[3];
+        // CircleMarker 走 canvas 绘制，避免每个点一个 SVG/CSS DOM 节点
+        var marker = L.circleMarker(new L.LatLng(row[0], row[1]), style);
+        marker.bindPopup(popup, {maxWidth: 250});
+        return marker;
+    };
+})()
+""" % json.dumps(POPUP_TMPL.split("%s"), ensure_ascii=False)
+
+def build_map(df_subset: pd.DataFrame, view: tuple[float, float, int]) -> folium.Map:
+    lat, lon, zoom = view
+    # 空集则定位中国中心（view_bounds 已给出）
     if df_subset.empty:
-        m = folium.Map(location=[35.0, 103.8], zoom_start=4, tiles="CartoDB positron")
+        m = folium.Map(location=[lat, lon], zoom_start=zoom, tiles="CartoDB positron")
         return m
 
     m = folium.Map(
-        location=[df_subset["latitude"].mean(), df_subset["longitude"].mean()],
-        zoom_start=5,
+        location=[lat, lon],
+        zoom_start=zoom,
         tiles="CartoDB positron",
+        prefer_canvas=True,
     )
-    cluster = MarkerCluster().add_to(m)
-
-    for _, row in df_subset.iterrows():
-        popup = (
-            f'<div style="padding:6px 10px;border-radius:8px;'
-            f'background:#ffffff;box-shadow:0 1px 4px rgba(0,0,0,.15);'
-            f'font-weight:500;font-size:0.75em;">{row["scenic"]}'
-            f'<br/><small style="font-size:0.4em;">{row["province"]}·{row["city"]}</small></div>'
-        )
-        folium.Marker(
-            location=(row["latitude"], row["longitude"]),
-            popup=folium.Popup(popup, max_width=250),
-            icon=BeautifyIcon(
-                icon_shape="circle",
-                border_color="#4a4a4a",
-                border_width=1,
-                background_color="#f5f5f5",
-                icon_size=[12, 12],
-            ),
-        ).add_to(cluster)
+    # 原始坐标数组一次性序列化，popup 与 CircleMarker 交给前端回调生成
+    # 分类列无法直接 fillna("")，先把文本列转为 object
+    data = (
+        df_subset[["latitude", "longitude", "scenic", "province", "city"]]
+        .astype({"scenic": object, "province": object, "city": object})
+        .fillna("")
+        .to_numpy()
+        .tolist()
+    )
+    # 分块加载 + 关闭动画：页面先可交互，标记分批加入，缩放时不做过渡动画
+    FastMarkerCluster(
+        data,
+        callback=MARKER_CALLBACK_JS,
+        chunked_loading=True,
+        chunk_interval=200,
+        chunk_delay=50,
+        animate=False,
+        animate_adding_markers=False,
+        remove_outside_visible_bounds=True,
+    ).add_to(m)
 
     return m
 
 
+@count_calls("build_map_cached")
+@st.cache_data(show_spinner=False, max_entries=64)   # 与 _cached_view 上限一致
+def build_map_cached(prov_key: tuple, city_key: tuple, mtime: float) -> str:   # mtime 参与 key
+    """Render the map to HTML once per selection; chat reruns hit the cache."""
+    bump_counter("build_map_cached.misses")
+    return build_map(*_cached_view(prov_key, city_key, mtime)).get_root().render()
+
+
 # ────────────── DeepSeek Chat Helper ──────────────
-_END_TOKEN = "__END_OF_STREAM__"
-def ask_deepseek(prompt: str, history: list[tuple[str, str]], temperature: float = 1.0):
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """Shared HTTP session (survives reruns) so TCP/TLS connections to DeepSeek are reused."""
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            # POST 默认不在 urllib3 重试范围内，需显式放开
+            max_retries=Retry(
+                total=2,
+                backoff_factor=0.5,
+                status_forcelist=(429, 502, 503, 504),
+                allowed_methods=frozenset(["POST"]),
+            ),
+        ),
+    )
+    return session
+
+SESSION = get_http_session()
+
+@st.cache_resource
+def get_llm_executor() -> ThreadPoolExecutor:
+    """Shared worker pool for secondary DeepSeek calls (e.g. summaries) that must not block the chat."""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="deepseek")
+
+LLM_EXECUTOR = get_llm_executor()
+
+ANSWER_CACHE_TTL = 7 * 24 * 3600   # 缓存答案保留 7 天
+CACHE_CHUNK_CHARS = 40             # 命中缓存时按块回放，保持流式观感
+
+@st.cache_resource
+def get_answer_cache() -> diskcache.Cache:
+    """On-disk cache of full DeepSeek answers, shared across sessions and restarts."""
+    cache = diskcache.Cache(str(ANSWER_CACHE_DIR))
+    cache.stats(enable=True)   # 记录 hits / misses，供调试面板查看
+    return cache
+
+CACHE = get_answer_cache()
+
+def answer_cache_key(prompt: str, history: list[tuple[str, str]], summary: str,
+                     temperature: float) -> str:
+    """Hash of the normalized question plus the context actually sent to DeepSeek."""
+    normalized = re.sub(r"\s+", " ", prompt).strip().lower()
+    raw = json.dumps([normalized, summary, history, temperature], ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+LLM_INFLIGHT_LIMIT = int(os.getenv("LLM_INFLIGHT_LIMIT", "4"))
+LLM_SLOT_TIMEOUT = 30      # 等待空闲并发槽的最长秒数
+MIN_ASK_INTERVAL = 1.0     # 同一会话两次提问的最小间隔（秒）
+
+@st.cache_resource
+def get_llm_semaphore() -> threading.BoundedSemaphore:
+    """Process-wide cap on concurrent DeepSeek requests, shared by all sessions."""
+    return threading.BoundedSemaphore(LLM_INFLIGHT_LIMIT)
+
+LLM_SEMAPHORE = get_llm_semaphore()
+
+@st.cache_resource
+def get_llm_waiters() -> tuple[Counter, threading.Lock]:
+    """Process-wide count of callers queued for a DeepSeek slot + its lock."""
+    return Counter(), threading.Lock()
+
+LLM_WAITERS, LLM_WAITERS_LOCK = get_llm_waiters()
+
+def acquire_llm_slot() -> bool:
+    """Take a DeepSeek slot; when callers have to queue, log queue depth, wait time and timeouts."""
+    if LLM_SEMAPHORE.acquire(blocking=False):
+        return True
+
+    with LLM_WAITERS_LOCK:
+        LLM_WAITERS["waiting"] += 1
+        depth = LLM_WAITERS["waiting"]
+    logger.info("DeepSeek inflight limit (%d) reached, %d caller(s) waiting for a slot",
+                LLM_INFLIGHT_LIMIT, depth)
+    start = time.monotonic()
+    try:
+        acquired = LLM_SEMAPHORE.acquire(timeout=LLM_SLOT_TIMEOUT)
+    finally:
+        with LLM_WAITERS_LOCK:
+            LLM_WAITERS["waiting"] -= 1
+    waited = time.monotonic() - start
+
+    if acquired:
+        logger.info("DeepSeek slot acquired after waiting %.1fs", waited)
+    else:
+        logger.warning("DeepSeek slot wait timed out after %.1fs (limit %d, timeout %ds)",
+                       waited, LLM_INFLIGHT_LIMIT, LLM_SLOT_TIMEOUT)
+    return acquired
+
+DEEPSEEK_URL = "https://api.deepseek.com/v1/chat/completions"
+DEEPSEEK_HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+}
+DEEPSEEK_TIMEOUT = (5, 90)   # (connect, read)：握手慢时快速失败，读超时按两次数据块间隔计
+STREAM_ATTEMPTS = 2          # 首个 token 到达前连接中断/超时则重试一次
+RECENT_MESSAGES = 4   # 最近 2 轮（问+答）原文发送，更早的内容折叠进摘要
+
+def summarize_history(prev_summary: str, history: list[tuple[str, str]]) -> str:
+    """
+    Fold older chat turns into the rolling summary with a small non-streaming call.
+    Returns "" on failure so the caller can keep the previous summary.
+    """
+    if not DEEPSEEK_API_KEY:
+        return ""
+
+    transcript = "\n".join(f"{role}: {content}" for role, content in history)
+    messages = [
+        {"role": "system", "content": "请用不超过100字的中文概括以下旅行问答对话的要点（用户关注的地点、偏好与结论）。"},
+        {"role": "user", "content": f"已有摘要：{prev_summary or '无'}\n\n新增对话：\n{transcript}"},
+    ]
+    payload = {
+        "model": "deepseek-chat",
+        "messages": messages,
+        "max_tokens": 150,
+        "temperature": 0.2,
+    }
+    if not acquire_llm_slot():
+        return ""
+    try:
+        resp = SESSION.post(DEEPSEEK_URL, headers=DEEPSEEK_HEADERS, json=payload, timeout=(DEEPSEEK_TIMEOUT[0], 30))
+        resp.raise_for_status()
+        return resp.json()["choices"][0]["message"]["content"].strip()
+    except Exception:
+        logger.warning("DeepSeek history summary failed; keeping previous summary", exc_info=True)
+        return ""
+    finally:
+        LLM_SEMAPHORE.release()
+
+def iter_sse_lines(resp: requests.Response):
+    """
+    Yield raw SSE lines (bytes) as soon as they arrive.
+    iter_content(chunk_size=None) hands over whatever the socket has; lines are split on b"\n" here.
+    """
+    buf = b""
+    for chunk in resp.iter_content(chunk_size=None):
+        buf += chunk
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if buf:
+        yield buf
+
+def clear_on_first_chunk(chunks, slot):
+    """Pass chunks through, clearing the placeholder `slot` once the first one arrives (or the stream ends)."""
+    try:
+        for chunk in chunks:
+            slot.empty()
+            yield chunk
+            break
+        yield from chunks
+    finally:
+        slot.empty()
+
+def ask_deepseek(prompt: str, history: list[tuple[str, str]], temperature: float = 1.0,
+                 summary: str = ""):
     """
     Call DeepSeek Chat Completion API and stream the answer.
-    Only uses the prompt text; model & parameters are fixed for simplicity.
+    Sends the rolling summary plus the last 2 turns verbatim; model & parameters are fixed for simplicity.
     """
     if not DEEPSEEK_API_KEY:
         yield "⚠️ 未设置 API Key，无法调用 DeepSeek。"
         return
 
-    url = "https://api.deepseek.com/v1/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-    }
-    # Build message history: system prompt + last 6 turns to conserve tokens
+    # 相同问题 + 相同上下文：直接回放缓存答案
+    recent = history[-RECENT_MESSAGES:]
+    key = answer_cache_key(prompt, recent, summary, temperature)
+    cached = CACHE.get(key)
+    if cached is not None:
+        for i in range(0, len(cached), CACHE_CHUNK_CHARS):
+            yield cached[i:i + CACHE_CHUNK_CHARS]
+        return
+
+    # Build message history: system prompt + summary of older turns to conserve tokens
     messages = [{"role": "system", "content": "你是一位中国旅行顾问，专门回答关于全国5A级景点的问答，并且应参考上下文连续回答。"}]
+    if summary:
+        messages.append({"role": "system", "content": f"此前对话摘要：{summary}"})
 
     # Append recent history
-    for role, content in history[-6:]:
+    for role, content in recent:
         messages.append({"role": role, "content": content})
 
     # Current user question
@@ -156,115 +449,156 @@ def ask_deepseek(prompt: str, history: list[tuple[str, str]], temperature: float
         "stream": True
     }
 
+    if not acquire_llm_slot():
+        yield "⏳ 当前提问人数较多，请稍后再试。"
+        return
     try:
-        with requests.post(url, headers=headers, json=payload, stream=True, timeout=120) as resp:
-            resp.raise_for_status()
-            full_answer = ""
-            for line in resp.iter_lines():
-                if not line or line == b": ping":
-                    continue  # skip keep‑alive
-
-                if line.startswith(b"data: "):
-                    data_str = line[6:]
-                    # Stream finished
-                    if data_str == b"[DONE]":
-                        break
-                    # Attempt to parse JSON; skip invalid chunks
-                    try:
-                        line_json = json.loads(data_str)
-                        delta = (line_json.get("choices")
-                                 and line_json["choices"][0]["delta"].get("content"))
-                        if delta:
-                            full_answer += delta
-                            yield delta
-                    except json.JSONDecodeError:
-                        continue  # ignore malformed line
-            return full_answer
-    except Exception as exc:
-        yield f"❌ 调用 DeepSeek 失败: {exc}"
-
-
-fmap = build_map(df_view)
-st_folium(fmap, use_container_width=True, height=680)
+        full_answer = ""
+        for attempt in range(STREAM_ATTEMPTS):
+            try:
+                with SESSION.post(DEEPSEEK_URL, headers=DEEPSEEK_HEADERS, json=payload,
+                                  stream=True, timeout=DEEPSEEK_TIMEOUT) as resp:
+                    resp.raise_for_status()
+                    done = False
+                    finish_reason = None
+                    for line in iter_sse_lines(resp):
+                        if not line or line == b": ping":
+                            continue  # skip keep‑alive
+
+                        if line.startswith(b"data: "):
+                            data_str = line[6:]
+                            # Stream finished
+                            if data_str == b"[DONE]":
+                                done = True
+                                break
+                            # Attempt to parse JSON; skip invalid chunks
+                            try:
+                                line_json = json.loads(data_str)
+                                choice = line_json.get("choices") and line_json["choices"][0]
+                                if not choice:
+                                    continue
+                                finish_reason = choice.get("finish_reason") or finish_reason
+                                delta = choice["delta"].get("content")
+                                if delta:
+                                    full_answer += delta
+                                    yield delta
+                            except json.JSONDecodeError:
+                                continue  # ignore malformed line
+                    # 只缓存完整答案：流正常结束且未因 max_tokens 等原因截断
+                    if full_answer and done and finish_reason == "stop":
+                        CACHE.set(key, full_answer, expire=ANSWER_CACHE_TTL)
+                    return full_answer
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as exc:
+                # 连接失败/超时/流被中途关闭：尚未输出任何内容时才重试，避免答案重复
+                if full_answer or attempt == STREAM_ATTEMPTS - 1:
+                    yield f"❌ 调用 DeepSeek 失败: {exc}"
+                    return
+            except Exception as exc:
+                yield f"❌ 调用 DeepSeek 失败: {exc}"
+                return
+    finally:
+        LLM_SEMAPHORE.release()
+
+map_html = build_map_cached(prov_key, city_key, DATA_CSV.stat().st_mtime)
+st.iframe(map_html, height=680)
+
+# ────────────── 缓存调试面板（?debug=1）──────────────
+if st.query_params.get("debug") == "1":
+    with st.sidebar.expander("Cache stats"):
+        with CACHE_COUNTERS_LOCK:
+            counts = Counter(CACHE_COUNTERS)
+        st.write({
+            name: {
+                "hits": counts[f"{name}.calls"] - counts[f"{name}.misses"],
+                "misses": counts[f"{name}.misses"],
+            }
+            for name in ("compute_view", "build_map_cached")
+        })
+        hits, misses = CACHE.stats()
+        st.write({"deepseek_cache": {"hits": hits, "misses": misses, "entries": len(CACHE)}})
 
 # ────────────── 景区问答对话框 ──────────────
 st.divider()
 st.subheader("🎤 5A 景点问答｜AI")
 
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
-
-# Show chat history
-for role, msg in st.session_state.chat_history:
-    if role == "user":
-        st.chat_message("user").write(msg)
-    else:
-        st.chat_message("assistant").write(msg)
-
-# Input box at bottom of the page
-user_question = st.chat_input("关于 5A 景点想问什么？")
-if user_question:
-    # --- 把用户问题写入界面 & 历史 ---
-    st.session_state.chat_history.append(("user", user_question))
-    st.chat_message("user").write(user_question)
-
-    # --- 先显示“思考中”占位 ---
-    assistant_container = st.chat_message("assistant")
-    with assistant_container:
-        thinking_slot = st.empty()
-        thinking_slot.write("🤔 Thinking...")
-
-    # --- 启动后台线程流式获取答案 ---
-    q: queue.Queue[str] = queue.Queue()
-
-    # Capture current history outside the thread (session_state is not thread‑safe)
-    history_snapshot = list(st.session_state.chat_history)
-
-    def _worker(history_local: list[tuple[str, str]]):
-        """Background thread: stream from DeepSeek and push to queue."""
-        try:
-            for chunk in ask_deepseek(user_question, history_local, temperature=0.3):
-                q.put(chunk or "")  # enqueue even empty chunk
-            q.put(_END_TOKEN)
-        except Exception as exc:
-            q.put(f"❌ DeepSeek 错误: {exc}")
-            q.put(_END_TOKEN)
-
-    threading.Thread(target=_worker, args=(history_snapshot,), daemon=True).start()
-
-    # --- 先阻塞直到拿到第一块内容，以便保持“Thinking...”更久 ---
-    streamed_answer = ""
-    try:
-        first_chunk = q.get(timeout=25)  # 最多等 25 秒
-    except queue.Empty:
-        thinking_slot.markdown("❌ 25 秒无响应，请稍后再试")
-        st.session_state.chat_history.append(("assistant", "25 秒无响应，请稍后再试"))
-        first_chunk = _END_TOKEN
-    if first_chunk == _END_TOKEN:
-        thinking_slot.markdown("❓ 未收到回答")
-        st.session_state.chat_history.append(("assistant", "未收到回答"))
-    else:
-        streamed_answer += first_chunk
-        thinking_slot.markdown(streamed_answer + "▌")
-
-        # --- 后续非阻塞轮询，继续拼接 ---
-        cursor_visible = True
-        last_update = time.time()
-
-        while True:
+# 聊天面板放在 fragment 中：提问只重跑这一段，不重建侧栏与地图
+@st.fragment
+def chat_panel():
+    if "chat_history" not in st.session_state:
+        st.session_state.chat_history = []
+    if "chat_summary" not in st.session_state:
+        st.session_state.chat_summary = ""
+        st.session_state.summary_upto = 0   # chat_history 中已折叠进摘要的条数
+
+    # fragment 内 chat_input 不再固定在页面底部，而是按顺序内联绘制；
+    # 所有消息都写进输入框之前创建的容器，保证新问答显示在输入框上方
+    msgs = st.container()
+
+    # Show chat history
+    for role, msg in st.session_state.chat_history:
+        if role == "user":
+            msgs.chat_message("user").write(msg)
+        else:
+            msgs.chat_message("assistant").write(msg)
+
+    # Input box below the conversation
+    user_question = st.chat_input("关于 5A 景点想问什么？")
+    if user_question and time.time() - st.session_state.get("last_ask", 0.0) < MIN_ASK_INTERVAL:
+        st.toast("提问太频繁，请稍候再试", icon="⏳")
+        user_question = None
+    if user_question:
+        st.session_state.last_ask = time.time()
+
+        # --- 取回上一轮后台生成的摘要；尚未完成则不等待，沿用旧摘要 ---
+        pending = st.session_state.get("summary_future")
+        if pending is not None and pending[0].done():
+            future, upto = st.session_state.pop("summary_future")
+            new_summary = future.result()
+            if new_summary:
+                st.session_state.chat_summary = new_summary
+                st.session_state.summary_upto = upto
+
+        # --- 历史快照不含本次问题（本次问题单独作为 prompt 发送）---
+        history_snapshot = list(st.session_state.chat_history)
+
+        # --- 把用户问题写入界面 & 历史 ---
+        st.session_state.chat_history.append(("user", user_question))
+        msgs.chat_message("user").write(user_question)
+
+        # --- 先显示“思考中”占位（推理阶段/排队等待时没有正文输出），再交给 st.write_stream ---
+        with msgs.chat_message("assistant"):
+            thinking_slot = st.empty()
+            thinking_slot.write("🤔 Thinking...")
             try:
-                chunk = q.get(timeout=0.1)
-                if chunk == _END_TOKEN:
-                    break
-                streamed_answer += chunk
-                thinking_slot.markdown(streamed_answer + ("▌" if cursor_visible else ""))
-            except queue.Empty:
-                # toggle cursor every 0.5 s for blink effect
-                if time.time() - last_update > 0.5:
-                    cursor_visible = not cursor_visible
-                    thinking_slot.markdown(streamed_answer + ("▌" if cursor_visible else ""))
-                    last_update = time.time()
-
-        # --- 写入历史并显示最终答案 ---
-        thinking_slot.markdown(streamed_answer)
-        st.session_state.chat_history.append(("assistant", streamed_answer))
\ No newline at end of file
+                streamed_answer = st.write_stream(
+                    clear_on_first_chunk(
+                        ask_deepseek(user_question, history_snapshot, temperature=0.3,
+                                     summary=st.session_state.chat_summary),
+                        thinking_slot,
+                    )
+                )
+            except Exception as exc:
+                streamed_answer = f"❌ DeepSeek 错误: {exc}"
+                st.markdown(streamed_answer)
+            if not streamed_answer:
+                streamed_answer = "未收到回答"
+                st.markdown("❓ 未收到回答")
+
+        # --- 写入历史 ---
+        st.session_state.chat_history.append(("assistant", streamed_answer))
+
+        # --- 超出最近 2 轮的旧对话在后台折叠进滚动摘要，不阻塞本次渲染 ---
+        history = st.session_state.chat_history
+        cutoff = len(history) - RECENT_MESSAGES
+        if (len(history) > RECENT_MESSAGES and cutoff > st.session_state.summary_upto
+                and "summary_future" not in st.session_state):   # 上一次折叠仍在进行则下轮再折叠
+            future = LLM_EXECUTOR.submit(
+                summarize_history,
+                st.session_state.chat_summary,
+                history[st.session_state.summary_upto:cutoff],
+            )
+            st.session_state.summary_future = (future, cutoff)
+
+
+chat_panel()